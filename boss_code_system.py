@@ -31,6 +31,12 @@ if "upload_code" in st.query_params and "auth_key" in st.query_params:
         c = conn.cursor()
         # 插入码，重复自动忽略
         c.execute("INSERT OR IGNORE INTO boss_codes (code) VALUES (?)", (input_code,))
+        if c.rowcount > 0:
+            # 累计写入行数（维护表由主程序初始化，不存在时跳过）
+            try:
+                c.execute("UPDATE db_maintenance SET pending_writes = pending_writes + 1 WHERE id = 1")
+            except sqlite3.OperationalError:
+                pass
         conn.commit()
         conn.close()
         st.write("API_SUCCESS")
@@ -42,16 +48,19 @@ if "upload_code" in st.query_params and "auth_key" in st.query_params:
 
 # ================= 【API逻辑之后，才能放其他所有代码】 =================
 import sqlite3
+import hashlib
 import random
+import secrets
+import threading
+import time
 import pandas as pd
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from streamlit_cookies_manager import EncryptedCookieManager
+from streamlit_cookies_manager import CookieManager
 
 # -------------------------- Cookie管理器初始化 --------------------------
-cookies = EncryptedCookieManager(
-    prefix="boss_code_final_v3_",
-    password="final_secure_pwd_v3_987654"
-)
+# Cookie中只保存不透明的会话令牌，身份与权限以服务端sessions表为准，无需加密
+cookies = CookieManager(prefix="boss_code_final_v4_")
 if not cookies.ready():
     st.stop()
 
@@ -68,11 +77,12 @@ def init_db():
             remain_receive_times INTEGER DEFAULT 10,
             daily_quota INTEGER DEFAULT 10,
             last_reset_date TEXT DEFAULT NULL,
+            session_generation INTEGER DEFAULT 0,
             create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     # 迁移旧表：添加新字段（如果不存在）
-    for col, definition in [("daily_quota", "INTEGER DEFAULT 1"), ("last_reset_date", "TEXT DEFAULT NULL")]:
+    for col, definition in [("daily_quota", "INTEGER DEFAULT 1"), ("last_reset_date", "TEXT DEFAULT NULL"), ("session_generation", "INTEGER DEFAULT 0")]:
         try:
             c.execute(f"ALTER TABLE users ADD COLUMN {col} {definition}")
         except:
@@ -101,6 +111,29 @@ def init_db():
         c.execute("ALTER TABLE receive_records ADD COLUMN batch_id TEXT")
     except:
         pass
+    # 数据库维护状态（单行）
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS db_maintenance (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pending_writes INTEGER DEFAULT 0,
+            last_analyze_time TEXT DEFAULT NULL,
+            last_vacuum_time TEXT DEFAULT NULL,
+            last_reclaimed_bytes INTEGER DEFAULT 0,
+            total_reclaimed_bytes INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO db_maintenance (id) VALUES (1)")
+    # 服务端会话：只保存令牌的SHA-256摘要；generation与users.session_generation不一致即视为已撤销
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            generation INTEGER NOT NULL,
+            expires_at TEXT NOT NULL,
+            create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions (user_id)")
     # 初始化默认管理员
     try:
         c.execute("INSERT INTO users (username, password, permission_level, remain_receive_times) VALUES (?, ?, ?, ?)",
@@ -139,21 +172,231 @@ def daily_reset_if_needed(user_id):
         c.execute("UPDATE users SET remain_receive_times=daily_quota, last_reset_date=? WHERE id=?", (today, user_id))
         conn.commit()
 
+# -------------------------- 数据库维护 --------------------------
+MAINTENANCE_WRITE_THRESHOLD = 500  # 累计写入达到该行数后更新查询统计信息
+MAINTENANCE_INTERVAL_SECONDS = 60  # 后台维护检查间隔，一个间隔内无新写入视为空闲
+VACUUM_STEP_PAGES = 200            # 每步增量回收的页数
+VACUUM_MAX_STEPS = 5               # 每次空闲维护最多执行的回收步数
+
+# 累计写入行数（在调用方commit前执行，随业务事务一起提交）
+def record_writes(n):
+    if n > 0:
+        c.execute("UPDATE db_maintenance SET pending_writes = pending_writes + ? WHERE id = 1", (n,))
+
+# 读取数据库空间及维护状态
+def get_db_stats(db):
+    page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+    row = db.execute("SELECT pending_writes, last_analyze_time, last_vacuum_time, last_reclaimed_bytes, total_reclaimed_bytes FROM db_maintenance WHERE id = 1").fetchone()
+    return {
+        "page_size": page_size,
+        "file_bytes": page_count * page_size,
+        "free_bytes": freelist_count * page_size,
+        "freelist_count": freelist_count,
+        "pending_writes": row[0],
+        "last_analyze_time": row[1],
+        "last_vacuum_time": row[2],
+        "last_reclaimed_bytes": row[3],
+        "total_reclaimed_bytes": row[4],
+    }
+
+# 执行维护：写入量达到阈值时更新统计信息，空闲页较多时分步增量回收；force=True时全部执行
+def run_db_maintenance(db, force=False):
+    stats = get_db_stats(db)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    analyzed, reclaimed = False, 0
+    if force or stats["pending_writes"] >= MAINTENANCE_WRITE_THRESHOLD:
+        # 完整ANALYZE：analysis_limit采样在大批量删除后会严重低估行数
+        db.execute("ANALYZE")
+        db.execute("UPDATE db_maintenance SET pending_writes = 0, last_analyze_time = ? WHERE id = 1", (now,))
+        db.commit()
+        analyzed = True
+    if stats["freelist_count"] > 0 and (force or stats["freelist_count"] >= VACUUM_STEP_PAGES):
+        freelist_count = stats["freelist_count"]
+        steps = 0
+        while freelist_count > 0 and (force or steps < VACUUM_MAX_STEPS):
+            # execute()只推进一步（回收一页），用executescript执行到底
+            db.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            new_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if new_count >= freelist_count:
+                break
+            freelist_count = new_count
+            steps += 1
+        reclaimed = (stats["freelist_count"] - freelist_count) * stats["page_size"]
+        if reclaimed > 0:
+            db.execute("""
+                UPDATE db_maintenance
+                SET last_vacuum_time = ?, last_reclaimed_bytes = ?, total_reclaimed_bytes = total_reclaimed_bytes + ?
+                WHERE id = 1
+            """, (now, reclaimed, reclaimed))
+            db.commit()
+    return analyzed, reclaimed
+
+# 开启增量回收模式（旧库需执行一次VACUUM完成转换），每个进程只执行一次，返回失败原因
+@st.cache_resource
+def enable_incremental_vacuum():
+    db = sqlite3.connect("boss_code_system.db")
+    try:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("VACUUM")
+        return None
+    except sqlite3.OperationalError as e:
+        return str(e)
+    finally:
+        db.close()
+
+# 后台维护线程（每个进程一个，使用独立连接），仅在一个检查间隔内无新写入时执行维护
+@st.cache_resource
+def start_maintenance_worker():
+    # 清除资源缓存后复用仍在运行的线程及其状态，避免重复启动
+    for thread in threading.enumerate():
+        if thread.name == "db-maintenance" and thread.is_alive():
+            return thread.state
+    state = {"last_check_time": None, "last_error": None}
+    def worker():
+        db = sqlite3.connect("boss_code_system.db", check_same_thread=False)
+        last_pending = None
+        while True:
+            time.sleep(MAINTENANCE_INTERVAL_SECONDS)
+            try:
+                pending = db.execute("SELECT pending_writes FROM db_maintenance WHERE id = 1").fetchone()[0]
+                if pending == last_pending:
+                    run_db_maintenance(db)
+                last_pending = pending
+                state["last_check_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                state["last_error"] = None
+            except sqlite3.Error as e:
+                # 提交失败时连接仍持有写锁，立即回滚释放，避免阻塞页面写入
+                db.rollback()
+                state["last_error"] = str(e)
+    thread = threading.Thread(target=worker, name="db-maintenance", daemon=True)
+    thread.state = state
+    thread.start()
+    return state
+
+vacuum_setup_error = enable_incremental_vacuum()
+maintenance_state = start_maintenance_worker()
+
+# 字节数转可读格式
+def format_bytes(n):
+    for unit in ["B", "KB", "MB"]:
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+# -------------------------- 服务端会话 --------------------------
+SESSION_TTL_REMEMBER = timedelta(days=7)  # 勾选"记住我"时的会话有效期
+SESSION_TTL_DEFAULT = timedelta(hours=12) # 未勾选时的会话有效期（仅保存在当前页面会话中）
+SESSION_CACHE_SIZE = 1024                 # 进程内令牌缓存条数上限
+
+# 进程内LRU缓存：token -> (user_id, username, permission_level, expires_at)，所有页面会话共享
+@st.cache_resource
+def get_session_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "generation": 0}
+
+# 令牌摘要（数据库中不保存明文令牌）
+def hash_session_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+# 创建会话并返回令牌
+def create_session(user_id, ttl):
+    now = datetime.now()
+    token = secrets.token_urlsafe(32)
+    c.execute("DELETE FROM sessions WHERE expires_at <= ?", (now.strftime("%Y-%m-%d %H:%M:%S"),))
+    c.execute("""
+        INSERT INTO sessions (token_hash, user_id, generation, expires_at)
+        SELECT ?, id, session_generation, ? FROM users WHERE id = ?
+    """, (hash_session_token(token), (now + ttl).strftime("%Y-%m-%d %H:%M:%S"), user_id))
+    conn.commit()
+    return token
+
+# 解析令牌对应的(user_id, username, permission_level)，无效/过期/已撤销返回None
+def resolve_session(token):
+    cache = get_session_cache()
+    now = datetime.now()
+    with cache["lock"]:
+        entry = cache["entries"].get(token)
+        if entry:
+            if entry[3] > now:
+                cache["entries"].move_to_end(token)
+                return entry[:3]
+            del cache["entries"][token]
+        generation = cache["generation"]
+    c.execute("""
+        SELECT s.user_id, u.username, u.permission_level, s.expires_at
+        FROM sessions s JOIN users u ON u.id = s.user_id
+        WHERE s.token_hash = ? AND s.generation = u.session_generation
+    """, (hash_session_token(token),))
+    row = c.fetchone()
+    if not row:
+        return None
+    expires_at = datetime.strptime(row[3], "%Y-%m-%d %H:%M:%S")
+    if expires_at <= now:
+        c.execute("DELETE FROM sessions WHERE token_hash = ?", (hash_session_token(token),))
+        conn.commit()
+        return None
+    with cache["lock"]:
+        # 查库期间发生过撤销则不写入缓存，避免缓存旧权限
+        if cache["generation"] == generation:
+            cache["entries"][token] = (row[0], row[1], row[2], expires_at)
+            if len(cache["entries"]) > SESSION_CACHE_SIZE:
+                cache["entries"].popitem(last=False)
+    return row[:3]
+
+# 注销单个会话
+def delete_session(token):
+    c.execute("DELETE FROM sessions WHERE token_hash = ?", (hash_session_token(token),))
+    conn.commit()
+    cache = get_session_cache()
+    with cache["lock"]:
+        cache["entries"].pop(token, None)
+
+# 撤销用户的全部会话（修改权限、重置密码、删除用户时在调用方commit前执行，随业务事务一起提交）
+def revoke_user_sessions(user_ids):
+    if not user_ids:
+        return
+    id_placeholders = ",".join(["?"] * len(user_ids))
+    c.execute(f"UPDATE users SET session_generation = session_generation + 1 WHERE id IN ({id_placeholders})", user_ids)
+    c.execute(f"DELETE FROM sessions WHERE user_id IN ({id_placeholders})", user_ids)
+
+# 清除已撤销用户的进程内缓存（调用方commit后执行）
+def evict_user_sessions(user_ids):
+    cache = get_session_cache()
+    with cache["lock"]:
+        cache["generation"] += 1
+        revoked = set(user_ids)
+        for token in [t for t, entry in cache["entries"].items() if entry[0] in revoked]:
+            del cache["entries"][token]
+
 # -------------------------- 登录状态初始化 --------------------------
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
     st.session_state.user_id = 0
     st.session_state.username = ""
     st.session_state.permission_level = 0
+    st.session_state.session_token = ""
     st.session_state.force_logout = False
 
-# 从Cookie同步登录状态
-if not st.session_state.logged_in and not st.session_state.get("force_logout"):
-    if cookies.get("user_id") and cookies.get("username") and cookies.get("permission_level"):
-        st.session_state.logged_in = True
-        st.session_state.user_id = int(cookies["user_id"])
-        st.session_state.username = cookies["username"]
-        st.session_state.permission_level = int(cookies["permission_level"])
+# 每次rerun都通过会话令牌解析身份，权限变更/撤销立即生效
+session_token = st.session_state.get("session_token", "")
+cookie_token = cookies.get("session_token")
+if not session_token and not st.session_state.get("force_logout"):
+    session_token = cookie_token or ""
+session = resolve_session(session_token) if session_token else None
+if session:
+    st.session_state.logged_in = True
+    st.session_state.session_token = session_token
+    st.session_state.user_id, st.session_state.username, st.session_state.permission_level = session
+else:
+    st.session_state.logged_in = False
+    st.session_state.session_token = ""
+    # 清理已失效的Cookie令牌（CookieManager的删除不处理前缀，只能覆盖为空值）
+    if cookie_token and cookie_token == session_token:
+        cookies["session_token"] = ""
+        cookies.save()
 
 # 已登录则执行每日重置检查
 if st.session_state.logged_in:
@@ -177,15 +420,14 @@ if not st.session_state.logged_in:
             c.execute("SELECT id, username, password, permission_level FROM users WHERE username = ?", (username,))
             user = c.fetchone()
             if user and password == user[2]:
-                # 写入Cookie
+                token = create_session(user[0], SESSION_TTL_REMEMBER if remember_me else SESSION_TTL_DEFAULT)
+                # 写入Cookie（仅保存令牌）
                 if remember_me:
-                    expires = datetime.now() + timedelta(days=7)
-                    cookies["user_id"] = str(user[0])
-                    cookies["username"] = user[1]
-                    cookies["permission_level"] = str(user[3])
-                    cookies.expires = expires
+                    cookies["session_token"] = token
                     cookies.save()
                 # 同步会话状态
+                st.session_state.session_token = token
+                st.session_state.force_logout = False
                 st.session_state.logged_in = True
                 st.session_state.user_id = user[0]
                 st.session_state.username = user[1]
@@ -237,7 +479,9 @@ if not st.session_state.logged_in:
                     st.error("该用户名不存在！")
                 else:
                     c.execute("UPDATE users SET password = ? WHERE username = ?", (new_pwd, reset_username))
+                    revoke_user_sessions([target_user[0]])
                     conn.commit()
+                    evict_user_sessions([target_user[0]])
                     st.success(f"用户【{reset_username}】的密码重置成功！请返回登录页使用新密码登录")
 
 # 已登录状态
@@ -249,8 +493,8 @@ else:
         st.subheader(f"欢迎 {st.session_state.username} | {role}")
     with col2:
         if st.button("退出登录", use_container_width=True, key="final_logout_btn"):
-            for key in list(cookies.keys()):
-                del cookies[key]
+            delete_session(st.session_state.session_token)
+            cookies["session_token"] = ""
             cookies.save()
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
@@ -280,6 +524,7 @@ else:
                             ok += 1
                         except:
                             dup += 1
+                    record_writes(ok)
                     conn.commit()
                     st.success(f"导入完成！\n有效码总数：{len(codes)}\n成功导入：{ok}个\n重复跳过：{dup}个")
                     with st.expander("查看解析到的Boss码", expanded=False):
@@ -306,6 +551,7 @@ else:
                                 ok += 1
                             except:
                                 dup += 1
+                        record_writes(ok)
                         conn.commit()
                         st.success(f"导入完成！\n有效码总数：{len(codes)}\n成功导入：{ok}个\n重复跳过：{dup}个")
                         with st.expander("查看解析到的Boss码", expanded=False):
@@ -329,6 +575,7 @@ else:
                         st.error("该ID的Boss码不存在！")
                     else:
                         c.execute("DELETE FROM receive_records WHERE code_id=?", (del_code_id,))
+                        record_writes(c.rowcount + 1)
                         c.execute("DELETE FROM boss_codes WHERE id=?", (del_code_id,))
                         conn.commit()
                         st.success(f"成功删除Boss码：{code_info[0]}（ID：{del_code_id}）")
@@ -350,6 +597,7 @@ else:
                             st.error("该ID范围内无Boss码！")
                         else:
                             c.execute("DELETE FROM receive_records WHERE code_id BETWEEN ? AND ?", (del_start_id, del_end_id))
+                            record_writes(c.rowcount + count)
                             c.execute("DELETE FROM boss_codes WHERE id BETWEEN ? AND ?", (del_start_id, del_end_id))
                             conn.commit()
                             st.success(f"批量删除完成！共删除 {count} 个Boss码")
@@ -391,7 +639,9 @@ else:
                                 st.error("次级管理员无权修改超级管理员的密码")
                             else:
                                 c.execute("UPDATE users SET password = ? WHERE username = ?", (admin_new_pwd, reset_uname))
+                                revoke_user_sessions([u[0]])
                                 conn.commit()
+                                evict_user_sessions([u[0]])
                                 st.success(f"用户【{reset_uname}】的密码已重置成功！")
                 else:
                     reset_uid = st.number_input("要重置的用户ID", min_value=1, step=1, key="admin_reset_uid")
@@ -408,7 +658,9 @@ else:
                                 st.error("次级管理员无权修改超级管理员的密码")
                             else:
                                 c.execute("UPDATE users SET password = ? WHERE id = ?", (admin_new_pwd, reset_uid))
+                                revoke_user_sessions([u[0]])
                                 conn.commit()
+                                evict_user_sessions([u[0]])
                                 st.success(f"用户【{u[1]}】的密码已重置成功！")
             
             st.divider()
@@ -473,8 +725,11 @@ else:
                                 st.error("不能删除超级管理员账号！")
                             else:
                                 c.execute("DELETE FROM receive_records WHERE user_id=?", (del_uid,))
+                                record_writes(c.rowcount + 1)
                                 c.execute("DELETE FROM users WHERE id=?", (del_uid,))
+                                revoke_user_sessions([del_uid])
                                 conn.commit()
+                                evict_user_sessions([del_uid])
                                 st.success(f"成功删除用户：{u[0]}（ID：{del_uid}），并清理了其所有领取记录")
                 else:
                     col1, col2, col3 = st.columns(3)
@@ -491,21 +746,25 @@ else:
                             st.error("不能删除包含自己账号的ID范围！")
                         else:
                             c.execute("""
-                                SELECT COUNT(*) FROM users 
+                                SELECT id FROM users 
                                 WHERE id BETWEEN ? AND ? 
                                 AND permission_level != 2
                             """, (del_user_start_id, del_user_end_id))
-                            count = c.fetchone()[0]
+                            del_user_ids = [row[0] for row in c.fetchall()]
+                            count = len(del_user_ids)
                             if count == 0:
                                 st.error("该ID范围内无普通用户/次级管理员可删除！")
                             else:
                                 c.execute("DELETE FROM receive_records WHERE user_id BETWEEN ? AND ?", (del_user_start_id, del_user_end_id))
+                                record_writes(c.rowcount + count)
                                 c.execute("""
                                     DELETE FROM users 
                                     WHERE id BETWEEN ? AND ? 
                                     AND permission_level != 2
                                 """, (del_user_start_id, del_user_end_id))
+                                revoke_user_sessions(del_user_ids)
                                 conn.commit()
+                                evict_user_sessions(del_user_ids)
                                 st.success(f"批量删除完成！共删除 {count} 个用户，并清理了其所有领取记录")
             
             st.divider()
@@ -584,6 +843,31 @@ else:
             col1.metric("总库存", total)
             col2.metric("剩余可领取", remain)
             col3.metric("已领取", used)
+
+            st.divider()
+            st.subheader("🧹 数据库维护")
+            st.caption(f"累计写入达到 {MAINTENANCE_WRITE_THRESHOLD} 行后自动更新查询统计信息，空闲页由后台线程在空闲时分步回收")
+            if st.button("立即执行完整维护（ANALYZE + 回收全部空闲页）", use_container_width=True, key="db_maintenance_btn"):
+                if vacuum_setup_error:
+                    # 重试增量回收模式转换
+                    enable_incremental_vacuum.clear()
+                    vacuum_setup_error = enable_incremental_vacuum()
+                analyzed, reclaimed = run_db_maintenance(conn, force=True)
+                st.success(f"维护完成！{'统计信息已更新，' if analyzed else ''}本次回收空间：{format_bytes(reclaimed)}")
+            if vacuum_setup_error:
+                st.warning(f"增量回收模式开启失败，空闲页暂无法回收：{vacuum_setup_error}")
+            if maintenance_state["last_error"]:
+                st.warning(f"后台维护出错：{maintenance_state['last_error']}")
+            db_stats = get_db_stats(conn)
+            col1, col2, col3 = st.columns(3)
+            col1.metric("数据库大小", format_bytes(db_stats["file_bytes"]))
+            col2.metric("待回收空间", format_bytes(db_stats["free_bytes"]))
+            col3.metric("累计回收空间", format_bytes(db_stats["total_reclaimed_bytes"]))
+            col1, col2, col3 = st.columns(3)
+            col1.metric("统计信息更新时间", db_stats["last_analyze_time"] or "从未更新")
+            col2.metric("统计后累计写入", f"{db_stats['pending_writes']} 行")
+            col3.metric("上次回收", format_bytes(db_stats["last_reclaimed_bytes"]) if db_stats["last_vacuum_time"] else "从未回收",
+                        help=db_stats["last_vacuum_time"])
         
         # ========== 权限设置 ==========
         if len(tabs) >= 5:
@@ -606,7 +890,9 @@ else:
                             st.error("目标用户不存在")
                         else:
                             c.execute("UPDATE users SET permission_level = ? WHERE id = ?", (target_permission[1], target_user_id))
+                            revoke_user_sessions([target_user_id])
                             conn.commit()
+                            evict_user_sessions([target_user_id])
                             st.success(f"用户【{target_user[0]}】的权限已修改为【{target_permission[0]}】")
                 
                 st.divider()
@@ -653,6 +939,7 @@ else:
             
             # 更新用户剩余次数
             c.execute("UPDATE users SET remain_receive_times = remain_receive_times - ? WHERE id = ?", (receive_num, st.session_state.user_id))
+            record_writes(receive_num * 2)
             conn.commit()
             
             # 显示结果